@@ -9,14 +9,36 @@ if using custom search need to using IMAP queries
 
 """
 
-import email
+import atexit
+import binascii
+import email.utils
 import imaplib
 import os
+import queue
+import quopri
 import re
 import getpass
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from email.header import decode_header
+from email.parser import BytesHeaderParser, BytesParser
+from email.policy import compat32
 from datetime import datetime, timedelta  
 
+# Characters not allowed in filenames, replaced with underscores
+_INVALID_FILENAME_CHARS = str.maketrans(dict.fromkeys('\\/*?:"<>|', "_"))
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?))')
+_ESCAPE_RE = re.compile(rb'\\(.)')
+_LITERAL_RE = re.compile(rb"\{\d+\}$")
+_HEADER_PARSER = BytesHeaderParser()
+_MESSAGE_PARSER = BytesParser(policy=compat32)
+_DECODE_CHUNK_SIZE = 64 * 1024
+_PREALLOCATE_MIN_SIZE = 1024 * 1024
+_GROUP_FETCH_MAX_SIZE = 32 * 1024 * 1024
+
+# Logged-in connections kept open across download_pdf_attachments calls
+_pool = {}
+
 def clean_filename(filename):
     """Clean and normalize filename for saving to disk"""
     if filename:
@@ -24,9 +46,405 @@ def clean_filename(filename):
         if isinstance(filename, bytes):
             filename = filename.decode()
         # Replace invalid chars with underscore
-        return re.sub(r'[\\/*?:"<>|]', "_", filename)
+        return filename.translate(_INVALID_FILENAME_CHARS)
     return "unnamed_attachment.pdf"
 
+def decode_subject(subject):
+    """Decode a raw Subject header into a string usable in filenames"""
+    if subject:
+        # Decode subject if needed
+        subject, encoding = decode_header(subject)[0]
+        if isinstance(subject, bytes):
+            subject = subject.decode(encoding or 'utf-8', errors='replace')
+        return clean_filename(subject)
+    return "no_subject"
+
+def fetch_messages(mail, message_uids, message_parts="(BODY.PEEK[])"):
+    """Fetch data items for a batch of messages with a single UID FETCH
+
+    Returns (status, {uid: {item name: value}}), e.g. {b"42": {b"BODY[]": raw}}.
+    """
+    status, msg_data = mail.uid("FETCH", b",".join(message_uids), message_parts)
+    if status != 'OK':
+        return status, {}
+    return status, parse_fetch_response(msg_data)
+
+def parse_fetch_response(msg_data):
+    """Parse a UID FETCH response into {uid: {item name: value}}"""
+    # Tokens go straight onto the list being built, NIL becomes None
+    stack = [[]]
+    current = stack[0]
+    for item in msg_data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            # (line ending in a {size} marker, literal)
+            text, literal = item
+            text = _LITERAL_RE.sub(b"", text)
+        else:
+            text, literal = item, None
+
+        for open_paren, close_paren, quoted, atom in _TOKEN_RE.findall(text):
+            if atom:
+                current.append(None if atom.upper() == b"NIL" else atom)
+            elif open_paren:
+                current = []
+                stack[-1].append(current)
+                stack.append(current)
+            elif close_paren:
+                if len(stack) > 1:
+                    stack.pop()
+                    current = stack[-1]
+            elif b"\\" in quoted:
+                current.append(_ESCAPE_RE.sub(rb"\1", quoted))
+            else:
+                current.append(quoted)
+
+        if literal is not None:
+            current.append(literal)
+
+    responses = {}
+    for items in stack[0]:
+        if isinstance(items, list):
+            fields = {
+                key.upper(): value
+                for key, value in zip(items[::2], items[1::2])
+                if isinstance(key, bytes)
+            }
+            if b"UID" in fields:
+                # A UID can come back in several untagged FETCHes, e.g. a FLAGS update
+                responses.setdefault(fields[b"UID"], {}).update(fields)
+    return responses
+
+def get_param(params, name):
+    """Look up a parameter in a BODYSTRUCTURE (key value ...) list, decoding RFC 2231 values"""
+    if not isinstance(params, list):
+        return None
+    # decode_params joins name*0/name*1 continuations and unquotes name*=charset''value
+    pairs = [("", "")] + [
+        (key.decode("ascii", errors="replace").lower(), value.decode("utf-8", errors="replace"))
+        for key, value in zip(params[::2], params[1::2])
+        if isinstance(key, bytes) and isinstance(value, bytes)
+    ]
+    for key, value in email.utils.decode_params(pairs)[1:]:
+        if key == name:
+            if isinstance(value, tuple):
+                # Encoded values keep their quotes, as in Message.get_param
+                value = (value[0], value[1], email.utils.unquote(value[2]))
+            return email.utils.collapse_rfc2231_value(value)
+    return None
+
+def find_pdf_parts(bodystructure):
+    """List (section, filename, encoding, size) for each PDF attachment in a BODYSTRUCTURE"""
+    pdf_parts = []
+    pending = [(bodystructure, "")]
+    while pending:
+        part, section = pending.pop()
+        maintype = part[0]
+
+        if isinstance(maintype, list):
+            # Multipart: child bodies come first, followed by the subtype
+            count = 0
+            for child in part:
+                if not isinstance(child, list):
+                    break
+                count += 1
+            prefix = f"{section}." if section else ""
+            for index in range(count, 0, -1):
+                pending.append((part[index - 1], f"{prefix}{index}"))
+            continue
+
+        # Most leaves are text or images, reject them before anything else
+        maintype = maintype.lower()
+        section = section or "1"
+        if maintype == b"message":
+            if part[1].lower() == b"rfc822":
+                # Attached message: its body follows the envelope
+                nested = part[8]
+                pending.append((nested, section if isinstance(nested[0], list) else f"{section}.1"))
+            continue
+        if maintype != b"application" or part[1].lower() != b"pdf" or len(part) < 9:
+            continue
+
+        # Non-text leaves have 7 basic fields, then MD5 and the disposition
+        disposition = part[8]
+        if not isinstance(disposition, list) or not disposition[0] or disposition[0].lower() != b"attachment":
+            continue
+
+        filename = get_param(disposition[1], "filename") or get_param(part[2], "name")
+        if filename:
+            encoding = (part[5] or b"7bit").decode("ascii", errors="replace").lower()
+            size = int(part[6]) if part[6] else 0
+            pdf_parts.append((section, filename, encoding, size))
+    return pdf_parts
+
+def decoded_size(size, encoding):
+    """Estimate the decoded size of a part body from its encoded size"""
+    return size * 3 // 4 if encoding == "base64" else size
+
+def write_payload(f, payload, encoding):
+    """Write a MIME part body to an open file, decoding base64 in 64KB chunks
+
+    Only one chunk is decoded at a time, so the decoded attachment is never
+    held in memory next to the encoded one.
+    """
+    if encoding == "quoted-printable":
+        f.write(quopri.decodestring(payload))
+        return
+    if encoding != "base64":
+        f.write(payload)
+        return
+
+    leftover = b""
+    for start in range(0, len(payload), _DECODE_CHUNK_SIZE):
+        chunk = payload[start:start + _DECODE_CHUNK_SIZE]
+        if isinstance(chunk, str):
+            chunk = chunk.encode("ascii", errors="ignore")
+        # Line breaks would shift the 4-character base64 groups across chunks
+        chunk = leftover + chunk.translate(None, b"\r\n\t ")
+        usable = len(chunk) - len(chunk) % 4
+        f.write(binascii.a2b_base64(chunk[:usable]))
+        leftover = chunk[usable:]
+
+    if leftover:
+        # Missing padding at the end, decode what is there like email does
+        try:
+            f.write(binascii.a2b_base64(leftover + b"=" * (-len(leftover) % 4)))
+        except binascii.Error:
+            pass
+
+def preallocate(f, size):
+    """Reserve disk space for a large file before writing it, where supported"""
+    if size < _PREALLOCATE_MIN_SIZE or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        # One call lets the filesystem pick contiguous extents up front
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        # Filesystem does not support it, just write normally
+        pass
+
+def save_attachment(filepath, payload, encoding):
+    """Write one attachment to disk and return its path"""
+    with open(filepath, "wb") as f:
+        # The estimate can be a little large, the excess is cut below
+        preallocate(f, decoded_size(len(payload), encoding))
+        write_payload(f, payload, encoding)
+        f.truncate()
+    return filepath
+
+def pdf_attachments_from_message(msg, max_attachment_size=None):
+    """List (filename, encoding, payload, size) for each PDF attachment of a parsed message
+
+    payload is None for attachments larger than max_attachment_size.
+    """
+    attachments = []
+
+    # Flat stack instead of walk()'s nested generators, only leaves are checked
+    pending = list(reversed(msg.get_payload())) if msg.is_multipart() else []
+    while pending:
+        part = pending.pop()
+        if part.is_multipart():
+            pending.extend(reversed(part.get_payload()))
+            continue
+        if part.get_content_type() != "application/pdf":
+            continue
+
+        # Check if it's an attachment (parsed disposition, no header copy)
+        if part.get_content_disposition() == "attachment":
+            filename = part.get_filename()
+            if filename:
+                if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+                    # Leave base64 encoded so it is decoded while writing
+                    encoding, payload = "base64", part.get_payload()
+                else:
+                    encoding, payload = None, part.get_payload(decode=True)
+                size = decoded_size(len(payload), encoding)
+                if max_attachment_size is not None and size > max_attachment_size:
+                    payload = None
+                attachments.append((filename, encoding, payload, size))
+    return attachments
+
+def fetch_full_message_attachments(mail, message_id, max_attachment_size=None):
+    """Return (subject, attachments) by downloading and parsing the whole message"""
+    status, raw_emails = fetch_messages(mail, [message_id])
+    raw_email = raw_emails.get(message_id, {}).get(b"BODY[]")
+    if raw_email is None:
+        raise imaplib.IMAP4.error("full message fetch failed")
+    msg = _MESSAGE_PARSER.parsebytes(raw_email)
+    attachments = pdf_attachments_from_message(msg, max_attachment_size)
+    # The subject is only used to name saved files
+    return (msg["Subject"] if attachments else None), attachments
+
+def fetch_batch_attachments(mail, batch, structures, max_attachment_size=None):
+    """Map message_id to (subject, [(filename, encoding, payload, size)]) for a batch of messages
+
+    Only the PDF sections listed in each BODYSTRUCTURE are downloaded, so
+    text, HTML and image parts never leave the server. Messages wanting the
+    same sections share one FETCH. Sections larger than max_attachment_size
+    are not downloaded and get a None payload. Messages that could not be
+    fetched are reported and left out.
+    """
+    results = {}
+    groups = {}
+    for message_id in batch:
+        fields = structures.get(message_id)
+        if fields is None or b"BODYSTRUCTURE" not in fields:
+            print(f"Error fetching message {message_id}: message not returned by server")
+            continue
+        try:
+            pdf_parts = find_pdf_parts(fields[b"BODYSTRUCTURE"])
+        except (IndexError, TypeError, AttributeError, ValueError):
+            # Unexpected BODYSTRUCTURE layout - fall back to the full message
+            try:
+                results[message_id] = fetch_full_message_attachments(mail, message_id, max_attachment_size)
+            except Exception as e:
+                print(f"Error fetching message {message_id}: {e}")
+            continue
+        if not pdf_parts:
+            results[message_id] = (None, [])
+            continue
+
+        # BODYSTRUCTURE carries each part's size, so oversized ones are never fetched
+        wanted = tuple(
+            section for section, _, encoding, size in pdf_parts
+            if max_attachment_size is None or decoded_size(size, encoding) <= max_attachment_size
+        )
+        fetch_size = sum(size for section, _, _, size in pdf_parts if section in wanted)
+        # Split a group once its response would get too large to hold at once
+        chunks = groups.setdefault(wanted, [])
+        if not chunks or (chunks[-1][1] and chunks[-1][0] + fetch_size > _GROUP_FETCH_MAX_SIZE):
+            chunks.append([0, []])
+        chunks[-1][0] += fetch_size
+        chunks[-1][1].append((message_id, pdf_parts))
+
+    for wanted, chunks in groups.items():
+        items = " ".join(["BODY.PEEK[HEADER.FIELDS (SUBJECT)]"] + [f"BODY.PEEK[{section}]" for section in wanted])
+        for _, messages in chunks:
+            try:
+                status, responses = fetch_messages(mail, [message_id for message_id, _ in messages], f"({items})")
+            except Exception as e:
+                print(f"Error fetching attachments of {len(messages)} messages: {e}")
+                continue
+
+            for message_id, pdf_parts in messages:
+                fields = responses.get(message_id)
+                if fields is None:
+                    print(f"Error fetching message {message_id}: attachment fetch failed")
+                    continue
+
+                header = next((value for key, value in fields.items() if key.startswith(b"BODY[HEADER")), None)
+                # Headers only - no body to split into parts
+                subject = _HEADER_PARSER.parsebytes(header or b"")["Subject"]
+
+                attachments = []
+                for section, filename, encoding, size in pdf_parts:
+                    if section not in wanted:
+                        attachments.append((filename, encoding, None, decoded_size(size, encoding)))
+                        continue
+                    payload = fields.get(f"BODY[{section}]".encode())
+                    if payload is not None:
+                        attachments.append((filename, encoding, payload, decoded_size(size, encoding)))
+                results[message_id] = (subject, attachments)
+    return results
+
+def iter_message_attachments(mail, message_uids, fetch_batch_size, mark_seen=False, max_attachment_size=None):
+    """Yield (message_id, subject, attachments) for every message, attachments is None on error
+
+    All fetches use BODY.PEEK, so flags are left alone unless mark_seen is
+    set, in which case each batch is flagged \\Seen with a single STORE.
+    """
+    for start in range(0, len(message_uids), fetch_batch_size):
+        batch = message_uids[start:start + fetch_batch_size]
+
+        # One round-trip for the structure of the whole batch
+        try:
+            status, structures = fetch_messages(mail, batch, "(BODYSTRUCTURE)")
+        except Exception as e:
+            print(f"Error fetching messages {batch[0].decode()}-{batch[-1].decode()}: {e}")
+            structures = {}
+
+        results = fetch_batch_attachments(mail, batch, structures, max_attachment_size) if structures else {}
+        for message_id in batch:
+            subject, attachments = results.get(message_id, (None, None))
+            yield message_id, subject, attachments
+
+        processed = [message_id for message_id in batch if message_id in results]
+        if mark_seen and processed:
+            try:
+                mail.uid("STORE", b",".join(processed), "+FLAGS.SILENT", "(\\Seen)")
+            except Exception as e:
+                print(f"Error marking messages as read: {e}")
+
+def prefetch(iterable, depth=1):
+    """Consume an iterable in a background thread, keeping up to depth items ready"""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up once the consumer has gone away instead of blocking forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+def get_connection(imap_server, imap_port, email_address, password):
+    """Return a logged-in connection for the account, reusing a pooled one if still alive"""
+    key = (imap_server, imap_port, email_address)
+    mail = _pool.get(key)
+    if mail is not None:
+        try:
+            if mail.noop()[0] == 'OK':
+                return mail
+        except Exception:
+            pass
+        # Dropped by the server (idle timeout etc.) - reconnect
+        del _pool[key]
+
+    mail = imaplib.IMAP4_SSL(imap_server, imap_port)
+    mail.login(email_address, password)
+    _pool[key] = mail
+    return mail
+
+def close_connections():
+    """Log out of every pooled connection"""
+    while _pool:
+        _, mail = _pool.popitem()
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+atexit.register(close_connections)
+
 def download_pdf_attachments(
     email_address,
     password,
@@ -34,7 +452,12 @@ def download_pdf_attachments(
     imap_port=993,
     search_criteria="ALL",
     output_dir="pdf_attachments",
-    days_limit=None
+    days_limit=None,
+    fetch_batch_size=100,
+    imap_client=None,
+    mark_seen=False,
+    use_server_side_filter=True,
+    max_attachment_mb=100
 ):
     
     # Create output directory if it doesn't exist
@@ -42,10 +465,9 @@ def download_pdf_attachments(
         os.makedirs(output_dir)
         print(f"Created directory: {output_dir}")
     
-    # Connect to the IMAP server
+    # Connect to the IMAP server, reusing an open connection when possible
     try:
-        mail = imaplib.IMAP4_SSL(imap_server, imap_port)
-        mail.login(email_address, password)
+        mail = imap_client or get_connection(imap_server, imap_port, email_address, password)
     except Exception as e:
         print(f"Error connecting to mail server: {e}")
         return []
@@ -61,12 +483,19 @@ def download_pdf_attachments(
 
         search_criteria = f'(SINCE {date_criteria}) {search_criteria}'
     
-    # Search for emails
-    status, messages = mail.search(None, search_criteria)
+    # Search for emails; Gmail can drop messages without PDFs server-side,
+    # other servers are filtered by the BODYSTRUCTURE check instead
+    try:
+        if use_server_side_filter and "X-GM-EXT-1" in mail.capabilities:
+            status, messages = mail.uid("SEARCH", None, search_criteria, "X-GM-RAW", '"has:attachment filename:pdf"')
+        else:
+            status, messages = mail.uid("SEARCH", None, search_criteria)
+    except imaplib.IMAP4.error as e:
+        print(f"Error searching mailbox: {e}")
+        return []
     
     if status != 'OK':
         print("No messages found!")
-        mail.logout()
         return []
         
     # Parse the messages
@@ -76,57 +505,76 @@ def download_pdf_attachments(
     
     print(f"Found {total_messages} messages matching criteria")
     
-    for i, message_id in enumerate(message_ids):
-        try:
-            print(f"Processing message {i+1}/{total_messages}...")
-            
-            # Fetch the message
-            status, msg_data = mail.fetch(message_id, "(RFC822)")
-            
-            if status != 'OK':
-                print(f"Error fetching message {message_id}")
+    # Fetch structures in batches and only download PDF parts; the next
+    # message is fetched in the background while the current one is written
+    max_attachment_size = max_attachment_mb * 1024 * 1024 if max_attachment_mb else None
+    messages = prefetch(
+        iter_message_attachments(mail, message_ids, fetch_batch_size, mark_seen, max_attachment_size)
+    )
+
+    # Directory part of every saved path, with exactly one trailing separator
+    output_prefix = os.path.join(output_dir, "")
+
+    # Attachments are written by a thread pool so disk I/O overlaps the fetches
+    write_workers = 4
+    with ThreadPoolExecutor(max_workers=write_workers) as pool:
+        futures = {}
+        # Caps payloads waiting in the pool's queue when the disk is slower than the server
+        pending_writes = threading.BoundedSemaphore(write_workers * 2)
+        # Names already carry <uid>_<n>, so this only matters for subjects that mimic that pattern
+        submitted_paths = set()
+        for i, (message_id, subject, attachments) in enumerate(messages, 1):
+            try:
+                print(f"Processing message {i}/{total_messages}...")
+
+                if not attachments:
+                    continue
+
+                # Get email subject for better naming, only messages with PDFs
+                # ever get here so other subjects are never decoded
+                subject = decode_subject(subject)
+
+                # The UID identifies the message, the attachment number
+                # tells same-named PDFs of one message apart
+                uid = message_id.decode()
+
+                for number, (filename, encoding, payload, size) in enumerate(attachments, 1):
+                    # Clean and create a unique filename
+                    clean_name = clean_filename(filename)
+                    filepath = "".join((output_prefix, subject, "_", uid, "_", str(number), "_", clean_name))
+                    if filepath in submitted_paths:
+                        base_name, ext = os.path.splitext(filepath)
+                        counter = 1
+                        while f"{base_name}_{counter}{ext}" in submitted_paths:
+                            counter += 1
+                        filepath = f"{base_name}_{counter}{ext}"
+                    submitted_paths.add(filepath)
+
+                    if payload is None:
+                        # Too large to download, leave a note in its place
+                        placeholder = f"{filepath}.skipped.txt"
+                        with open(placeholder, "w") as f:
+                            f.write(f"{filename} was not downloaded: about {size / 1048576:.1f} MB, "
+                                    f"limit is {max_attachment_mb} MB\n")
+                        print(f"Skipped (too large): {placeholder}")
+                        continue
+
+                    # Save the attachment
+                    pending_writes.acquire()
+                    future = pool.submit(save_attachment, filepath, payload, encoding)
+                    future.add_done_callback(lambda _: pending_writes.release())
+                    futures[future] = message_id
+            except Exception as e:
+                print(f"Error processing message {message_id}: {e}")
+
+        for future in as_completed(futures):
+            try:
+                filepath = future.result()
+            except Exception as e:
+                print(f"Error processing message {futures[future]}: {e}")
                 continue
-                
-            # Parse the raw email message
-            raw_email = msg_data[0][1]
-            msg = email.message_from_bytes(raw_email)
-            
-            # Get email subject for better naming
-            subject = msg["Subject"]
-            if subject:
-                # Decode subject if needed
-                subject, encoding = decode_header(subject)[0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode(encoding or 'utf-8', errors='replace')
-                subject = clean_filename(subject)
-            else:
-                subject = "no_subject"
-            
-            # Process attachments
-            if msg.is_multipart():
-                for part in msg.walk():
-                    content_disposition = str(part.get("Content-Disposition", ""))
-                    
-                    # Check if it's an attachment and a PDF
-                    if "attachment" in content_disposition and part.get_content_type() == "application/pdf":
-                        filename = part.get_filename()
-                        if filename:
-                            # Clean and create a unique filename
-                            clean_name = clean_filename(filename)
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            unique_filename = f"{subject}_{timestamp}_{clean_name}"
-                            
-                            # Save the attachment
-                            filepath = os.path.join(output_dir, unique_filename)
-                            with open(filepath, "wb") as f:
-                                f.write(part.get_payload(decode=True))
-                            print(f"Downloaded: {filepath}")
-                            downloaded_files.append(filepath)
-        except Exception as e:
-            print(f"Error processing message {message_id}: {e}")
-    
-    # Logout when done
-    mail.logout()
+            print(f"Downloaded: {filepath}")
+            downloaded_files.append(filepath)
     
     print(f"Downloaded {len(downloaded_files)} PDF attachments")
     return downloaded_files
@@ -175,7 +623,9 @@ def main():
         imap_port=imap_port,
         search_criteria=search_criteria,
         output_dir=output_dir,
-        days_limit=days_limit
+        days_limit=days_limit,
+        # Unread-only runs rely on processed messages being marked as read
+        mark_seen=search_option == "2"
     )
     
     # Report results
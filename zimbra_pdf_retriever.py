@@ -4,28 +4,156 @@ Zimbra PDF Retriever via IMAP
 Requires: imap-tools (pip install imap-tools)
 """
 
+import atexit
 import os
-import re
+import queue
 import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from imap_tools import MailBox, AND
 
+# Characters not allowed in filenames, replaced with underscores
+_INVALID_FILENAME_CHARS = str.maketrans(dict.fromkeys('\\/*?:"<>|', "_"))
+
+_PREALLOCATE_MIN_SIZE = 1024 * 1024
+
+# Logged-in mailboxes kept open across download_pdf_attachments calls
+_pool = {}
+
 def clean_filename(filename):
     """Clean and normalize filename for saving to disk"""
     if filename:
-        return re.sub(r'[\\/*?:"<>|]', "_", filename)
+        return filename.translate(_INVALID_FILENAME_CHARS)
     return "unnamed_attachment.pdf"
 
-def get_monthly_folder(email_date, base_output_dir):
-    """Determine the monthly subfolder (e.g., 2025-05) based on email date"""
+def get_monthly_folder(email_date, base_output_dir, created_folders=None):
+    """Determine the monthly subfolder (e.g., 2025-05) based on email date
+
+    Folders already in created_folders are returned without touching the disk.
+    """
     year = email_date.year
     month = email_date.month
     folder_name = f"{year}-{month:02d}"  # Format as YYYY-MM
     monthly_folder = os.path.join(base_output_dir, folder_name)
-    if not os.path.exists(monthly_folder):
-        os.makedirs(monthly_folder)
+    if created_folders is not None and monthly_folder in created_folders:
+        return monthly_folder
+    os.makedirs(monthly_folder, exist_ok=True)
+    if created_folders is not None:
+        created_folders.add(monthly_folder)
     return monthly_folder
 
+def prefetch(iterable, depth=1):
+    """Consume an iterable in a background thread, keeping up to depth items ready"""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up once the consumer has gone away instead of blocking forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+def get_connection(server, email, password):
+    """Return a logged-in MailBox for the account, reusing a pooled one if still alive"""
+    key = (server, email)
+    mailbox = _pool.get(key)
+    if mailbox is not None:
+        try:
+            if mailbox.client.noop()[0] == "OK":
+                return mailbox
+        except Exception:
+            pass
+        # Dropped by the server (idle timeout etc.) - reconnect
+        del _pool[key]
+
+    mailbox = MailBox(server, port=993)
+    mailbox.login(email, password, initial_folder=None)
+    _pool[key] = mailbox
+    return mailbox
+
+def close_connections():
+    """Log out of every pooled mailbox"""
+    while _pool:
+        _, mailbox = _pool.popitem()
+        try:
+            mailbox.logout()
+        except Exception:
+            pass
+
+atexit.register(close_connections)
+
+def reserve_path(monthly_folder, filename, used_names):
+    """Claim an unused path for filename in the folder by creating it empty
+
+    Clashing names get a _N suffix. used_names keeps the next N per name so
+    repeats go straight to a free suffix, and the exclusive create skips
+    files left by earlier runs. The file is closed again straight away so
+    queued writes do not hold a descriptor each.
+    """
+    base_name, ext = os.path.splitext(filename)
+    key = (monthly_folder, filename)
+    counter = used_names[key]
+    while True:
+        new_filename = f"{base_name}_{counter}{ext}" if counter else filename
+        final_path = os.path.join(monthly_folder, new_filename)
+        counter += 1
+        try:
+            # 0o666 so the umask applies like a plain open(..., "wb")
+            os.close(os.open(final_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        except FileExistsError:
+            continue
+        used_names[key] = counter
+        return final_path
+
+def preallocate(f, size):
+    """Reserve disk space for a large file before writing it, where supported"""
+    if size < _PREALLOCATE_MIN_SIZE or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        # One call lets the filesystem pick contiguous extents up front
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        # Filesystem does not support it, just write normally
+        pass
+
+def save_attachment(final_path, payload):
+    """Write one attachment to its reserved path and return the path"""
+    with open(final_path, "wb") as f:
+        preallocate(f, len(payload))
+        f.write(payload)
+    return final_path
+
 def download_pdf_attachments(
     email,
     password,
@@ -35,7 +163,11 @@ def download_pdf_attachments(
     folder_name="INBOX",
     only_unread=False,
     search_term=None,
-    debug=False
+    debug=False,
+    fetch_batch_size=100,
+    imap_client=None,
+    mark_seen=False,
+    max_attachment_mb=100
 ):
     """Download PDF attachments via IMAP into monthly folders"""
     if not os.path.exists(output_dir):
@@ -43,15 +175,16 @@ def download_pdf_attachments(
         print(f"Created directory: {output_dir}")
 
     downloaded_files = []
+    max_attachment_size = max_attachment_mb * 1024 * 1024 if max_attachment_mb else None
 
     try:
-        # Connect to IMAP server
+        # Connect to IMAP server, reusing an open connection when possible
         if debug:
             print(f"Connecting to {server}:993 with email {email}")
-        mailbox = MailBox(server, port=993)
+        mailbox = imap_client or get_connection(server, email, password)
 
-        # Login
-        mailbox.login(email, password, initial_folder=folder_name)
+        # Select the folder to search
+        mailbox.folder.set(folder_name)
         if debug:
             print(f"Successfully logged in to folder: {folder_name}")
 
@@ -74,48 +207,79 @@ def download_pdf_attachments(
         if debug:
             print(f"Search criteria: {search_criteria}")
 
-        # Fetch messages (all messages if no criteria)
-        messages = mailbox.fetch(search_criteria) if search_criteria else mailbox.fetch()
-        total_messages = sum(1 for _ in messages)  # Count messages
-        messages = mailbox.fetch(search_criteria) if search_criteria else mailbox.fetch()  # Reset iterator
+        # Count with a UID SEARCH only - no message bodies are transferred
+        total_messages = len(mailbox.uids(search_criteria or "ALL"))
+
+        # Fetch messages (all messages if no criteria), fetch_batch_size per FETCH;
+        # BODY.PEEK unless mark_seen, so flags are not changed as a side effect
+        messages = mailbox.fetch(search_criteria or "ALL", bulk=fetch_batch_size, mark_seen=mark_seen)
+        # Keep the next bulk FETCH running while attachments are being saved;
+        # imap_tools already buffers a batch, so only a couple of parsed
+        # messages are queued on top of it
+        messages = prefetch(messages, depth=2)
         print(f"Found {total_messages} messages")
 
-        # Process each message
-        for i, msg in enumerate(messages, 1):
-            subject = clean_filename(msg.subject)
-            print(f"Processing message {i}/{total_messages}: {subject}")
-
-            # Determine the monthly subfolder based on email date
-            email_date = msg.date
-            monthly_folder = get_monthly_folder(email_date, output_dir)
-            if debug:
-                print(f"  Saving to monthly folder: {monthly_folder}")
-
-            # Check attachments manually
-            if msg.attachments:
-                for att in msg.attachments:
-                    if att.filename.lower().endswith(".pdf"):
-                        filename = clean_filename(att.filename)
-                        print(f"  Downloading: {filename}")
-
-                        # Ensure unique filename within the monthly folder
-                        base_name, ext = os.path.splitext(filename)
-                        final_path = os.path.join(monthly_folder, filename)
-                        counter = 1
-                        while os.path.exists(final_path):
-                            new_filename = f"{base_name}_{counter}{ext}"
-                            final_path = os.path.join(monthly_folder, new_filename)
-                            counter += 1
-
-                        # Save attachment
-                        with open(final_path, "wb") as f:
-                            f.write(att.payload)
-                        downloaded_files.append(final_path)
-                        print(f"  Saved: {final_path}")
-
-        mailbox.logout()
-        if debug:
-            print("Logged out of IMAP server")
+        # Attachments are written by a thread pool so disk I/O overlaps the fetches
+        write_workers = 4
+        with ThreadPoolExecutor(max_workers=write_workers) as pool:
+            futures = {}
+            # Caps payloads waiting in the pool's queue when the disk is slower than the server
+            pending_writes = threading.BoundedSemaphore(write_workers * 2)
+            used_names = defaultdict(int)  # Next _N suffix per (folder, filename)
+            monthly_folders = set()  # Created during this run
+
+            try:
+                # Process each message
+                for i, msg in enumerate(messages, 1):
+                    subject = clean_filename(msg.subject)
+                    print(f"Processing message {i}/{total_messages}: {subject}")
+
+                    # Determine the monthly subfolder based on email date
+                    email_date = msg.date
+                    monthly_folder = get_monthly_folder(email_date, output_dir, monthly_folders)
+                    if debug:
+                        print(f"  Saving to monthly folder: {monthly_folder}")
+
+                    # Check attachments manually
+                    if msg.attachments:
+                        for att in msg.attachments:
+                            if att.filename.lower().endswith(".pdf"):
+                                filename = clean_filename(att.filename)
+
+                                if max_attachment_size is not None and att.size > max_attachment_size:
+                                    # Too large to save, leave a note in its place
+                                    placeholder = reserve_path(monthly_folder, f"{filename}.skipped.txt", used_names)
+                                    with open(placeholder, "w") as f:
+                                        f.write(f"{att.filename} was not saved: {att.size / 1048576:.1f} MB, "
+                                                f"limit is {max_attachment_mb} MB\n")
+                                    print(f"  Skipped (too large): {placeholder}")
+                                    continue
+
+                                print(f"  Downloading: {filename}")
+
+                                # Ensure unique filename within the monthly folder
+                                final_path = reserve_path(monthly_folder, filename, used_names)
+
+                                # Save attachment
+                                pending_writes.acquire()
+                                future = pool.submit(save_attachment, final_path, att.payload)
+                                future.add_done_callback(lambda _: pending_writes.release())
+                                futures[future] = final_path
+            finally:
+                # Always report files already written, even if fetching failed
+                for future in as_completed(futures):
+                    try:
+                        final_path = future.result()
+                    except Exception as e:
+                        print(f"  Error saving attachment: {e}")
+                        # Free the reserved name so later runs can use it
+                        try:
+                            os.remove(futures[future])
+                        except OSError:
+                            pass
+                        continue
+                    downloaded_files.append(final_path)
+                    print(f"  Saved: {final_path}")
 
     except Exception as e:
         print(f"Error: {e}")
@@ -151,7 +315,9 @@ def main():
         folder_name=folder,
         only_unread=only_unread,
         search_term=search_term,
-        debug=debug_mode
+        debug=debug_mode,
+        # Unread-only runs rely on processed messages being marked as read
+        mark_seen=only_unread
     )
 
     if downloaded_files: